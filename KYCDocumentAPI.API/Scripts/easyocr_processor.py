@@ -1,116 +1,400 @@
+import os
+
+# Split cores between PyTorch inference and OpenCV's parallel_for_ so they don't
+# oversubscribe each other. OMP/MKL read these at import time, so set them first.
+_NUM_THREADS = max(1, (os.cpu_count() or 1) // 2)
+os.environ.setdefault('OMP_NUM_THREADS', str(_NUM_THREADS))
+os.environ.setdefault('MKL_NUM_THREADS', str(_NUM_THREADS))
+
+import bisect
 import easyocr
 import cv2
 import numpy as np
-import os
-from typing import List, Dict, Any
+import re
+import threading
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from easyocr.utils import get_paragraph
+from typing import List, Dict, Any, Tuple, Union
+
+cv2.setNumThreads(_NUM_THREADS)
+torch.set_num_threads(_NUM_THREADS)
+
+PRECISIONS = ('default', 'fp32', 'fp16', 'int8')
+
+# Model load takes seconds, so readers are shared by every processor in the process
+_READERS: Dict[Tuple[Tuple[str, ...], bool, str], easyocr.Reader] = {}
+_READERS_LOCK = threading.Lock()
+
+# Batched GPU recognition pads every crop in a recognize() call to that call's widest
+# aspect ratio, so boxes are grouped by ratio (upper bounds below) before batching
+_RECOGNIZE_RATIO_BUCKETS = (4, 8, 16)
+_RECOGNIZE_BATCH_SIZE = 16
+
+# Thresholds for treating an input as an already-clean digital document: share of
+# near-black/near-white pixels and of isolated speckles (pixels more than
+# _CLEAN_SPECKLE_DELTA beyond all 8 neighbours) at full resolution, plus skew
+# measured on a 1/8-scale copy
+_CLEAN_MIN_NEAR_BINARY = 0.95
+_CLEAN_SPECKLE_DELTA = 16
+_CLEAN_MAX_SPECKLE = 0.002
+_CLEAN_MAX_SKEW = 0.5
+_NEIGHBOUR_RING = np.array([[1, 1, 1], [1, 0, 1], [1, 1, 1]], dtype=np.uint8)
+
+# OCR commonly reads the letter O as 0; only swap it back when not next to digits
+_OCR_ZERO_TO_O = re.compile(r'(?<=\D)0(?=\D)')
+
+# Context-free character fixes, applied in a single str.translate pass
+_OCR_CHAR_FIXES = str.maketrans({
+    '|': 'I',
+    '\u201C': '"',
+    '\u201D': '"',
+    '\u2018': "'",
+    '\u2019': "'",
+})
+
+
+class _Fp16Autocast(torch.nn.Module):
+    """Run the wrapped model under CUDA fp16 autocast and hand back float32 outputs."""
+
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, *args, **kwargs):
+        with torch.autocast('cuda', dtype=torch.float16):
+            return self.model(*args, **kwargs).float()
+
+
+def get_reader(languages: List[str], use_gpu: bool, precision: str = 'default') -> easyocr.Reader:
+    """Return the process-wide Reader for this language set, loading it on first use."""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unsupported precision: {precision}")
+
+    key = (tuple(languages), use_gpu, precision)
+    with _READERS_LOCK:
+        reader = _READERS.get(key)
+        if reader is None:
+            # easyocr applies int8 dynamic quantization itself (CPU only) unless told not
+            # to; 'default' keeps that behaviour and 'fp32' opts out
+            kwargs = {}
+            if precision in ('fp32', 'int8'):
+                kwargs['quantize'] = precision == 'int8'
+            reader = easyocr.Reader(languages, gpu=use_gpu, cudnn_benchmark=True, **kwargs)
+            if precision == 'fp16' and str(reader.device).startswith('cuda'):
+                # Only the recognizer: the detector's score maps feed cv2.threshold,
+                # which rejects float16
+                reader.recognizer = _Fp16Autocast(reader.recognizer)
+            _READERS[key] = reader
+    return reader
 
 
 class EasyOCRProcessor:
-    def __init__(self, languages: List[str] = None, use_gpu: bool = True):
+    def __init__(self, languages: List[str] = None, use_gpu: bool = True, precision: str = 'default'):
         """
         :param languages: List of languages to use (default: ['en', 'hi'])
         :param use_gpu: Use GPU if available
+        :param precision: 'default' (easyocr's own: int8 on CPU, fp32 on GPU), 'fp32',
+                          'fp16' (CUDA autocast of the recognizer) or 'int8' (CPU dynamic
+                          quantization); ignored on devices that don't support it
         """
         if languages is None:
             languages = ['en', 'hi']
 
-        self.reader = easyocr.Reader(languages, gpu=use_gpu)
+        self.reader = get_reader(languages, use_gpu, precision)
+
+        # Non-local means is CPU-only in stock OpenCV; use the CUDA build when present
+        self.use_cuda_denoise = (use_gpu and hasattr(cv2, 'cuda')
+                                 and cv2.cuda.getCudaEnabledDeviceCount() > 0)
+        self._local = threading.local()
+        # Long-lived so its worker threads keep their scratch buffers across batches;
+        # sized to the cv2/torch thread budget so concurrent workers don't oversubscribe
+        self._executor = ThreadPoolExecutor(max_workers=_NUM_THREADS)
+
+        # Route cv2 calls on UMat through OpenCL (T-API) when a device is present
+        cv2.ocl.setUseOpenCL(True)
+        self.use_opencl = cv2.ocl.haveOpenCL()
+
+    def close(self) -> None:
+        """Shut down the preprocessing workers, releasing their scratch buffers."""
+        self._executor.shutdown(wait=True)
+
+    def _buf(self, name: str, shape: Tuple[int, ...], dtype=np.uint8) -> Union[np.ndarray, None]:
+        """Per-thread scratch array for an intermediate, reused while its shape and dtype hold.
+
+        Returns None on the UMat path, where OpenCL keeps its own buffer pool.
+        """
+        if self.use_opencl:
+            return None
+        scratch = getattr(self._local, 'scratch', None)
+        if scratch is None:
+            scratch = self._local.scratch = {}
+        buf = scratch.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = scratch[name] = np.empty(shape, dtype=dtype)
+        return buf
+
+    def denoise(self, gray: Union[np.ndarray, cv2.UMat]) -> Union[np.ndarray, cv2.UMat]:
+        """Denoise with CUDA NLM (h=30) if available, else an edge-preserving bilateral filter."""
+        if self.use_cuda_denoise:
+            if isinstance(gray, cv2.UMat):
+                gray = gray.get()
+            # One cached GpuMat per thread so batch preprocessing can run concurrently
+            gpu_gray = getattr(self._local, 'gpu_gray', None)
+            if gpu_gray is None:
+                gpu_gray = self._local.gpu_gray = cv2.cuda_GpuMat()
+            gpu_gray.upload(gray)
+            return cv2.cuda.fastNlMeansDenoising(gpu_gray, h=30).download(
+                self._buf('denoised', gray.shape))
+        if isinstance(gray, cv2.UMat):
+            return cv2.bilateralFilter(gray, 5, 40, 40)
+        return cv2.bilateralFilter(gray, 5, 40, 40, dst=self._buf('denoised', gray.shape))
+
+    @staticmethod
+    def _skew_angle(binary: Union[np.ndarray, cv2.UMat]) -> float:
+        """Skew of the foreground pixels in degrees, folded into (-45, 45]."""
+        # findNonZero yields the packed (x, y) int32 points minAreaRect expects
+        coords = cv2.findNonZero(binary)
+        if isinstance(coords, cv2.UMat):
+            # An empty UMat result downloads as None
+            coords = coords.get()
+        angle = cv2.minAreaRect(coords)[-1] if coords is not None else 0.0
+        # Fold into (-45, 45] regardless of the OpenCV version's angle range
+        if angle > 45:
+            angle -= 90
+        elif angle < -45:
+            angle += 90
+        return angle
+
+    def is_clean_document(self, gray: Union[np.ndarray, cv2.UMat]) -> bool:
+        """Cheap check for digital/scanner-app inputs that preprocessing would not improve."""
+        # Digital renders are near-binary; noise, shading and blur all fill the mid-tones
+        hist = cv2.calcHist([gray], [0], None, [256], [0, 256])
+        if isinstance(hist, cv2.UMat):
+            hist = hist.get()
+        hist = hist.ravel()
+        total = hist.sum()
+        if (hist[:64].sum() + hist[192:].sum()) / total < _CLEAN_MIN_NEAR_BINARY:
+            return False
+
+        # Sensor and salt-and-pepper noise leave isolated extrema that downscaling would
+        # average away, so count them before resizing; stroke pixels always have a
+        # like-valued neighbour and don't register
+        below = cv2.subtract(cv2.erode(gray, _NEIGHBOUR_RING), gray)
+        above = cv2.subtract(gray, cv2.dilate(gray, _NEIGHBOUR_RING))
+        _, speckle = cv2.threshold(cv2.max(below, above), _CLEAN_SPECKLE_DELTA, 255,
+                                   cv2.THRESH_BINARY)
+        if cv2.countNonZero(speckle) / total > _CLEAN_MAX_SPECKLE:
+            return False
+
+        small = cv2.resize(gray, None, fx=0.125, fy=0.125, interpolation=cv2.INTER_AREA)
+        if isinstance(small, cv2.UMat):
+            small = small.get()
+        if min(small.shape) < 16:
+            return False
+
+        _, ink = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+        return abs(self._skew_angle(ink)) < _CLEAN_MAX_SKEW
+
+    def preprocess_image(self, image_path: str, options: Dict[str, Any] = None) -> np.ndarray:
+        """Preprocess image for better OCR: denoise, deskew, scale up, binarize.
+
+        With options['smart_preprocess'] (default True), already-clean inputs are
+        returned as plain grayscale.
+        """
+        return self._preprocess(image_path, options)[0]
+
+    def _preprocess(self, image_path: str, options: Dict[str, Any] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """preprocess_image plus the 2x3 affine mapping source pixels onto the result."""
+        if options is None:
+            options = {}
 
-    def preprocess_image(self, image_path: str) -> str:
-        """Preprocess image for better OCR: denoise, deskew, scale up, binarize."""
         image = cv2.imread(image_path)
         if image is None:
             raise ValueError(f"Could not read image: {image_path}")
 
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        (h, w) = image.shape[:2]
+        if self.use_opencl:
+            image = cv2.UMat(image)
 
-        # Denoise
-        denoised = cv2.fastNlMeansDenoising(gray, h=30)
+        # Intermediates go into reused scratch buffers; only the final warp allocates
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self._buf('gray', (h, w)))
+
+        if options.get('smart_preprocess', True) and self.is_clean_document(gray):
+            # gray may be a scratch buffer, so hand back an owned copy
+            clean = gray.get() if isinstance(gray, cv2.UMat) else gray.copy()
+            return clean, np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
 
-        # Scale up small text
-        scaled = cv2.resize(denoised, None, fx=2, fy=2,
-                            interpolation=cv2.INTER_CUBIC)
+        # Denoise
+        denoised = self.denoise(gray)
 
-        # Threshold (binarization)
+        # Threshold (binarization) at original resolution
         _, thresh = cv2.threshold(
-            scaled, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+            denoised, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=self._buf('thresh', (h, w)))
 
-        # Deskew
-        coords = np.column_stack(np.where(thresh > 0))
-        angle = cv2.minAreaRect(coords)[-1]
-        if angle < -45:
-            angle = -(90 + angle)
-        else:
-            angle = -angle
-        (h, w) = thresh.shape
-        M = cv2.getRotationMatrix2D((w // 2, h // 2), angle, 1.0)
-        deskewed = cv2.warpAffine(
-            thresh, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+        # Deskew, estimating the angle from the ink (dark) pixels rather than the page
+        ink = cv2.bitwise_not(thresh, dst=self._buf('ink', (h, w)))
+        angle = self._skew_angle(ink)
 
-        # Save temporary preprocessed file
-        preprocessed_path = image_path.replace('.', '_preprocessed.')
-        cv2.imwrite(preprocessed_path, deskewed)
-        return preprocessed_path
+        # Rotate and scale up small text in a single warp
+        M = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 2.0)
+        M[:, 2] += (w / 2, h / 2)
+        deskewed = cv2.warpAffine(
+            thresh, M, (2 * w, 2 * h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        return (deskewed.get() if isinstance(deskewed, cv2.UMat) else deskewed), M
 
     def clean_text(self, text: str) -> str:
         """Clean up OCR text without corrupting numbers."""
-        text = ' '.join(text.split())
+        # Collapse whitespace and fix common OCR issues
+        text = ' '.join(text.split()).translate(_OCR_CHAR_FIXES)
         # Replace 0→O only when surrounded by letters
-        import re
-        text = re.sub(r'(?<=\D)0(?=\D)', 'O', text)
-        # Fix common OCR issues
-        text = text.replace('|', 'I')
-        return text.strip()
+        return _OCR_ZERO_TO_O.sub('O', text)
 
     def extract_text(self, image_path: str, options: Dict[str, Any] = None) -> Dict[str, Any]:
         if options is None:
             options = {}
 
-        processed_image_path = self.preprocess_image(image_path)
+        processed_image, transform = self._preprocess(image_path, options)
 
-        extract_word_details = options.get('extract_word_details', True)
-        confidence_threshold = options.get(
-            'confidence_threshold', 0.3)  # Lower threshold
-        paragraph_mode = options.get('paragraph_mode', True)
+        results = self._readtext_bucketed(processed_image)
+
+        return self._build_result(results, options, transform)
+
+    def _readtext_bucketed(self, image: np.ndarray) -> List[Any]:
+        """Per-box reader.readtext results, batching recognition in aspect-ratio buckets on GPU."""
+        if self.reader.device == 'cpu':
+            # easyocr recognizes one box at a time on CPU, so bucketing buys nothing there
+            return self.reader.readtext(
+                image, width_ths=0.7, height_ths=0.7, add_margin=0.2)
+
+        horizontal_list, free_list = self.reader.detect(
+            image, width_ths=0.7, height_ths=0.7, add_margin=0.2)
+        horizontal_list, free_list = horizontal_list[0], free_list[0]
 
-        results = self.reader.readtext(
-            processed_image_path,
-            detail=extract_word_details,
-            paragraph=paragraph_mode,
+        # recognize() re-sorts its crops by top edge and may drop degenerate ones, so
+        # results are matched back to detection order through their output boxes
+        (max_y, max_x) = image.shape[:2]
+        horizontal_order = {}
+        for i, (x_min, x_max, y_min, y_max) in enumerate(horizontal_list):
+            key = (max(0, x_min), max(0, y_min), min(x_max, max_x), min(y_max, max_y))
+            horizontal_order.setdefault(key, []).append(i)
+        free_order = {}
+        for i, box in enumerate(free_list, start=len(horizontal_list)):
+            free_order.setdefault(tuple(np.ravel(box).tolist()), []).append(i)
+
+        buckets = [[] for _ in range(len(_RECOGNIZE_RATIO_BUCKETS) + 1)]
+        for box in horizontal_list:
+            x_min, x_max, y_min, y_max = box
+            ratio = (x_max - x_min) / max(y_max - y_min, 1)
+            buckets[bisect.bisect_right(_RECOGNIZE_RATIO_BUCKETS, ratio)].append(box)
+
+        indexed = []
+        for bucket in buckets:
+            if bucket:
+                for item in self.reader.recognize(
+                        image, horizontal_list=bucket, free_list=[],
+                        batch_size=_RECOGNIZE_BATCH_SIZE, reformat=False):
+                    (x0, y0), _, (x1, y1), _ = item[0]
+                    indexed.append((horizontal_order[(x0, y0, x1, y1)].pop(0), item))
+        if free_list:
+            for item in self.reader.recognize(
+                    image, horizontal_list=[], free_list=free_list,
+                    batch_size=_RECOGNIZE_BATCH_SIZE, reformat=False):
+                indexed.append((free_order[tuple(np.ravel(item[0]).tolist())].pop(0), item))
+
+        indexed.sort(key=lambda pair: pair[0])
+        return [item for (_, item) in indexed]
+
+    def process_images(self, image_paths: List[str], options: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        """Run OCR over several images in a single batched detection pass."""
+        if options is None:
+            options = {}
+        if not image_paths:
+            return []
+
+        processed_images, transforms = zip(*self._executor.map(
+            partial(self._preprocess, options=options), image_paths))
+
+        # readtext_batched needs equal-sized inputs and would otherwise stretch them, so
+        # pad each image with white on the bottom/right; boxes stay in its own frame
+        height = max(img.shape[0] for img in processed_images)
+        width = max(img.shape[1] for img in processed_images)
+        padded = [cv2.copyMakeBorder(img, 0, height - img.shape[0], 0, width - img.shape[1],
+                                     cv2.BORDER_CONSTANT, value=255)
+                  for img in processed_images]
+
+        batch_results = self.reader.readtext_batched(
+            padded,
             width_ths=0.7,
             height_ths=0.7,
             add_margin=0.2
         )
 
-        extracted_text = ""
+        return [self._build_result(results, options, transform)
+                for results, transform in zip(batch_results, transforms)]
+
+    def _build_result(self, results: List[Any], options: Dict[str, Any],
+                      transform: np.ndarray) -> Dict[str, Any]:
+        extract_word_details = options.get('extract_word_details', True)
+        confidence_threshold = options.get(
+            'confidence_threshold', 0.3)  # Lower threshold
+
+        # Recognition always runs per box so the confidences are real; paragraph mode
+        # then merges the (box, text, confidence) detections into text blocks
+        confidences = [float(confidence) for (_, _, confidence) in results]
+        if options.get('paragraph_mode', True) and results:
+            paragraphs = get_paragraph(results)
+            # Score each block by the detections whose centres fall inside it
+            centres = np.asarray([box for (box, _, _) in results], dtype=np.float64).mean(axis=1)
+            blocks = np.asarray([box for (box, _) in paragraphs], dtype=np.float64)
+            inside = ((centres[None] >= blocks.min(axis=1)[:, None])
+                      & (centres[None] <= blocks.max(axis=1)[:, None])).all(axis=2)
+            scores = np.asarray(confidences)
+            results = [(box, text, float(scores[mask].mean()) if mask.any() else None)
+                       for (box, text), mask in zip(paragraphs, inside)]
+
+        text_parts = []
         word_details = []
 
         if extract_word_details:
-            for detection in results:
-                bbox, text, confidence = detection
-                text = self.clean_text(text)
+            # Axis-aligned boxes for every detection at once from the (N, 4, 2) corner array,
+            # mapped back through the inverse preprocessing transform into source pixels
+            corners = np.asarray([item[0] for item in results], dtype=np.float64).reshape(-1, 4, 2)
+            inverse = cv2.invertAffineTransform(transform)
+            corners = corners @ inverse[:, :2].T + inverse[:, 2]
+            top_left = np.rint(corners.min(axis=1)).astype(np.int32)
+            bottom_right = np.rint(corners.max(axis=1)).astype(np.int32)
+
+            for i, item in enumerate(results):
+                text = self.clean_text(item[1])
 
                 if not text.strip():
                     continue
 
+                confidence = item[2]
                 word_details.append({
                     "text": text,
-                    "confidence": float(confidence),
-                    "bounding_box": bbox,
-                    "low_confidence": confidence < confidence_threshold
+                    "confidence": confidence,
+                    "bounding_box": {
+                        "x": int(top_left[i, 0]),
+                        "y": int(top_left[i, 1]),
+                        "width": int(bottom_right[i, 0] - top_left[i, 0]),
+                        "height": int(bottom_right[i, 1] - top_left[i, 1])
+                    },
+                    "low_confidence": confidence is not None and confidence < confidence_threshold
                 })
 
-                extracted_text += text + " "
+                text_parts.append(text)
         else:
-            extracted_text = " ".join([self.clean_text(text)
-                                      for (_, text, _) in results])
+            text_parts = [self.clean_text(item[1]) for item in results]
 
-        extracted_text = extracted_text.strip()
+        extracted_text = " ".join(text_parts).strip()
 
         return {
             "engine": "easyocr",
             "success": True,
             "extracted_text": extracted_text,
-            "confidence": float(np.mean([c for (_, _, c) in results]) if results else 0),
+            "confidence": float(np.mean(confidences)) if confidences else 0,
             "word_details": word_details
         }